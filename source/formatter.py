@@ -3,18 +3,21 @@
  load into database
 2. An (optionally) rewritten input file containing a uuid identifier
 """
+import concurrent.futures
+import functools
+import itertools
 import logging
 import os
-import traceback
+import re
 import csv
 import sys
-import uuid
 import datetime
 import json
 import gzip
-import shutil
+import io
 
 from typing import Dict
+from urllib.parse import parse_qs
 
 from standardize_molecule import standardize_to_noniso_smiles
 from data_manager_metadata.metadata import Metadata, FieldsDescriptorAnnotation
@@ -22,6 +25,14 @@ from data_manager_metadata.data_tier_api import get_metadata_filenames
 from data_manager_metadata.annotation_utils import est_schema_field_type
 
 from rdkit import Chem, RDLogger
+from rdkit.Chem.inchi import MolToInchi, InchiToInchiKey
+
+# orjson is optional, it's (much) faster than the json module,
+# which is used if it's not installed.
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # The columns *every* standard file is expected to contain.
 # All standard files must start with these columns.
@@ -36,6 +47,37 @@ _BASE_FIELD_NAMES = {
              'required': True, 'active': True},
     }
 
+# The number of input rows read (and standardised by the worker processes)
+# in each batch, and the number of rows passed to a worker in each task.
+_BATCH_SIZE = 10000
+_CHUNK_SIZE = 256
+
+# The number of records processed between progress events.
+_PROGRESS_INTERVAL = 50000
+
+# The buffer size used for the (potentially very large) input and
+# output files. Much larger than the default (8KiB) to reduce the number
+# of read/write calls.
+_BUFFER_SIZE = 1 << 20
+
+# The compression level used when writing a gzip dataset.
+# Level 1 is several times faster than the default (9) and the file
+# is only a little larger.
+_GZIP_COMPRESS_LEVEL = 1
+
+# The number of standardised smiles cached by each worker process.
+# Datasets often contain duplicate smiles, which then skip RDKit.
+# Each worker has its own cache, so this is kept fairly small.
+_STANDARDIZE_CACHE_SIZE = 1 << 16
+
+# The (lower-case) values accepted for true/false processing variables
+_TRUE_VALUES = {'true', '1', 'yes'}
+_FALSE_VALUES = {'false', '0', 'no'}
+
+# A uuid (in its canonical, hyphenated, form)
+_UUID_RE = re.compile('[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-'
+                      '[0-9a-fA-F]{4}-[0-9a-fA-F]{12}')
+
 # Two loggers - one for basic logging, one for events.
 basic_logger = logging.getLogger('basic')
 basic_logger.setLevel(logging.INFO)
@@ -72,61 +114,132 @@ def get_processing_variables():
     process_vars = {}
 
     # Set defaults
-    _valid_params = ['generate_uuid', 'header']
+    # The default number of workers is the number of CPUs this process
+    # can run on.
+    # Failed records are summarised (rather than logged individually)
+    # unless log_failures is set.
+    _valid_params = ['generate_uuid', 'header', 'workers', 'log_failures']
     process_vars['generate_uuid'] = True
     process_vars['header'] = True
+    process_vars['log_failures'] = False
+    process_vars['workers'] = len(os.sched_getaffinity(0))
 
     if not dataset_extra_variables:
         return process_vars
 
-    # Split into list of pairs
     try:
-        params = dataset_extra_variables.split('&')
-        for row in params:
-            param = row.split('=')
-            if param[0].lower() in _valid_params:
-                process_vars[param[0]] = param[1]
-
-        if isinstance(process_vars['generate_uuid'], str) and \
-                process_vars['generate_uuid'].lower() in ['false']:
-            process_vars['generate_uuid'] = False
-
-        if isinstance(process_vars['header'], str) and \
-                process_vars['header'].lower() in ['false']:
-            process_vars['header'] = False
-
-        return process_vars
-
-    except:  # pylint: disable=bare-except
-        event_logger.error('Problem decoding parameters - please check format')
+        params = parse_qs(dataset_extra_variables, keep_blank_values=True)
+        for name, values in params.items():
+            name = name.lower()
+            if name not in _valid_params:
+                continue
+            # If a variable is repeated its last value is used
+            value = values[-1]
+            if name == 'workers':
+                process_vars[name] = int(value)
+                if process_vars[name] < 1:
+                    raise ValueError('workers must be at least 1')
+            elif value.lower() in _TRUE_VALUES:
+                process_vars[name] = True
+            elif value.lower() in _FALSE_VALUES:
+                process_vars[name] = False
+            else:
+                raise ValueError('%s must be true or false' % name)
+    except ValueError as ex:
+        event_logger.error('Problem decoding parameters - please check format'
+                           ' (%s)', ex)
         sys.exit(1)
 
+    return process_vars
+
 
 def noniso_smiles(smiles: str):
     """"
     Return a non-isometric smiles representation
-    If this fails then the file is likely to be rubbish..
+    If RDKit raises an error for the smiles then (None, None) is returned,
+    which callers treat as a failure to standardize (like any other
+    invalid smiles) rather than stopping the whole run.
     """
 
     try:
-        noniso = standardize_to_noniso_smiles(smiles)
-        return noniso
-    except:  # pylint: disable=bare-except
-        traceback.print_exc()
-        event_logger.error('%s Caused a failure in RDKit', smiles)
-        sys.exit(1)
+        return standardize_to_noniso_smiles(smiles)
+    except (ValueError, RuntimeError):
+        return None, None
+
+
+def _init_worker():
+    """Initialise a standardisation worker process. Workers don't rely on
+    inheriting the RDKit logging level from the parent (they won't if
+    they're spawned rather than forked).
+    """
+    # Suppress basic RDKit logging...
+    RDLogger.logger().setLevel(RDLogger.ERROR)
+
+
+def _looks_like_smiles(smiles: str):
+    """A cheap check that rejects values that can't be smiles (empty, or
+    with unbalanced brackets) before they reach RDKit. Anything passing is
+    still parsed (and may be rejected) by RDKit.
+    """
+    return bool(smiles) \
+        and smiles.count('(') == smiles.count(')') \
+        and smiles.count('[') == smiles.count(']') \
+        and '\n' not in smiles
+
+
+@functools.lru_cache(maxsize=_STANDARDIZE_CACHE_SIZE)
+def _standardize_record(smiles: str):
+    """Standardise the given smiles and calculate the molecule properties
+    written to the loader file. This runs in a worker process, so only
+    primitives (not the RDKit molecule) are returned - which also keeps the
+    cached results small.
+
+    :param smiles: The input smiles
+    :returns: A tuple of (noniso smiles, inchis, inchik, hac) or None if
+              the smiles failed to standardize.
+    """
+    if not _looks_like_smiles(smiles):
+        return None
+
+    noniso = noniso_smiles(smiles)
+    if not noniso[1]:
+        return None
+
+    # The loader file needs both the InChI and the InChIKey, so the key is
+    # derived from the InChI string - MolToInchiKey() would generate the
+    # InChI again.
+    inchis = MolToInchi(noniso[1], '')
+    return noniso[0], inchis, InchiToInchiKey(inchis), \
+        noniso[1].GetNumHeavyAtoms()
+
+
+def _uuid_batch(num_uuids):
+    """Return a list of random (version 4) uuid strings. The random bytes
+    for all of them come from one os.urandom() call, rather than one call
+    per uuid (as made by uuid.uuid4()). The version and variant bits are
+    set on the raw bytes and the strings are cut from a single hex string,
+    which avoids building (and formatting) a uuid.UUID object for each.
+    """
+    random_bytes = bytearray(os.urandom(16 * num_uuids))
+    for i in range(0, len(random_bytes), 16):
+        # Version 4 (byte 6) and the RFC 4122 variant (byte 8)
+        random_bytes[i + 6] = random_bytes[i + 6] & 0x0f | 0x40
+        random_bytes[i + 8] = random_bytes[i + 8] & 0x3f | 0x80
+    hex_digits = random_bytes.hex()
+    return ['-'.join((hex_digits[i:i + 8], hex_digits[i + 8:i + 12],
+                      hex_digits[i + 12:i + 16], hex_digits[i + 16:i + 20],
+                      hex_digits[i + 20:i + 32]))
+            for i in range(0, len(hex_digits), 32)]
 
 
 def is_valid_uuid(value: str):
     """"
-    Checks whether ths given value is a UUID
+    Checks whether ths given value is a UUID (in its canonical form).
+    A regular expression is used rather than uuid.UUID() as it avoids
+    raising (and catching) an exception for every invalid value.
+    Values of the wrong length are rejected before the expression is used.
     """
-
-    try:
-        uuid.UUID(str(value))
-        return True
-    except ValueError:
-        return False
+    return len(value) == 36 and _UUID_RE.fullmatch(value) is not None
 
 
 def check_name_in_fields(field, value, fields) -> dict:
@@ -138,244 +251,476 @@ def check_name_in_fields(field, value, fields) -> dict:
     return fields
 
 
-def uncompress_file():
-    """"
-    Uncompress the file into the same location
-    Remove .gz from filename
+def open_dataset_file(filename, mode):
+    """Open the given dataset file in text mode for reading ('r') or
+    writing ('w'). If it's a gzip file it's decompressed (or compressed)
+    as it's streamed.
+    :param filename: the file to open
+    :param mode: 'r' or 'w'
+    :returns: text file object
     """
-    uncompressed_filename = os.path.splitext(dataset_filename)[0]
-    uncompressed_path = os.path.join(dataset_input_path, uncompressed_filename)
-
-    uncompressed_filename = os.path.splitext(dataset_filename)[0]
-    uncompressed_path = os.path.join(dataset_input_path, uncompressed_filename)
-    with gzip.open(input_filename, 'rt') as f_in:
-        with open(uncompressed_path, 'w') as f_out:
-            shutil.copyfileobj(f_in, f_out)
+    if not filename.endswith('.gz'):
+        return open(filename, mode + 't', buffering=_BUFFER_SIZE,
+                    newline='')
 
-    return uncompressed_path, uncompressed_filename
+    if mode == 'r':
+        buffered_file = io.BufferedReader(gzip.open(filename, 'rb'),
+                                          buffer_size=_BUFFER_SIZE)
+    else:
+        buffered_file = io.BufferedWriter(
+            gzip.open(filename, 'wb', compresslevel=_GZIP_COMPRESS_LEVEL),
+            buffer_size=_BUFFER_SIZE)
+    return io.TextIOWrapper(buffered_file, encoding='utf-8', newline='')
 
 
-def compress_file():
-    """"
-    Recompress the file into the same location
-    Remove the uncompressed file
+def check_file_format(input_csv):
+    """Identify delimiter, perform basic file level checks and return column
+    headings, along with a reader for the rows to process. The rows read
+    for the checks are returned by the reader, so the file is only read
+    once.
+
+    :param input_csv: the (open) input file
+    :returns: dialect (incl delimiter), input headings, output headings,
+    index of column containing smiles, index of column containing uuid,
+    a reader for the input rows (excluding the heading) and the list its
+    raw lines are recorded in
     """
-    compressed_path = \
-        os.path.join(dataset_output_path, dataset_filename)
-    with open(output_filename, 'rb') as f_in:
-        with gzip.open(compressed_path, 'wb') as f_out:
-            shutil.copyfileobj(f_in, f_out)
 
+    # The delimiter is whichever of tab or comma appears most in the
+    # first line. As with csv.Sniffer, spaces after the delimiter are
+    # skipped if every delimiter is followed by one.
+    first_line = input_csv.readline()
+    delimiter = '\t' if first_line.count('\t') > first_line.count(',') \
+        else ','
+    if delimiter not in first_line:
+        event_logger.error\
+            ('Problem with file delimiter - must be a comma or a tab')
+        sys.exit(1)
 
-    # Tidy up
-    os.remove(output_filename)
-    os.remove(input_filename)
+    csv.register_dialect('input', delimiter=delimiter,
+                         skipinitialspace=first_line.count(delimiter) ==
+                         first_line.count(delimiter + ' '))
+    input_dialect = csv.get_dialect('input')
+
+    # Rewind (rather than re-open) the file to read the rows.
+    input_csv.seek(0)
+
+    # When generating uuids the raw input lines are recorded, so the
+    # records can be rewritten without re-serialising every column.
+    # Not if the dialect skips spaces after a delimiter, as the rewritten
+    # records have those spaces removed.
+    raw_lines = []
+    if processing_vars['generate_uuid'] \
+            and not input_dialect.skipinitialspace:
+        input_csv = _recorded_lines(input_csv, raw_lines)
+    # Blank lines are skipped (as they are by a csv.DictReader).
+    input_reader = filter(None, csv.reader(input_csv, dialect=input_dialect))
+
+    # Normally, the first row should contain headings and these are used
+    # as the column names in the Fields Descriptor. If headings=False,
+    # the first line of data is used for the column names.
+    old_headings = next(input_reader)
+    if processing_vars['header']:
+        raw_lines.clear()
+        first_row = next(input_reader)
+    else:
+        first_row = old_headings
+
+    # First column should contain be 'smiles'
+    # Second column should be 'uuid' if not generating uuid
+    smiles_idx = 0
+    uuid_idx = 1
+    smiles = first_row[smiles_idx]
+    uuid_value = first_row[uuid_idx]
+
+    # Only check that the value parses as smiles. Skipping sanitisation
+    # and standardisation (which the record gets during processing)
+    # makes this much cheaper.
+    if not _looks_like_smiles(smiles) \
+            or Chem.MolFromSmiles(smiles, sanitize=False) is None:
+        event_logger.error\
+            ('Problem with file - First column must be smiles')
+        sys.exit(1)
 
+    if not processing_vars['generate_uuid'] \
+            and not is_valid_uuid(uuid_value):
+        event_logger.error\
+            ('Problem with file - Second column heading must be uuid')
+        sys.exit(1)
 
-def check_file_format():
-    """Identify delimiter, perform basic file level checks and return column
-    headings
-    :returns: dialect (incl delimiter), headings, column containing smiles,
-    column containing uuid
+    if processing_vars['generate_uuid'] \
+            and not is_valid_uuid(uuid_value):
+        # If generating uuid and second column is not uuid then add uuid
+        # to output headings.
+        new_headings = list(old_headings)
+        new_headings.insert(uuid_idx, 'uuid')
+    else:
+        new_headings = old_headings
+
+    # The first row is returned ahead of the rows still to be read.
+    input_reader = itertools.chain([first_row], input_reader)
+
+    return input_dialect, old_headings, new_headings, smiles_idx, uuid_idx, \
+        input_reader, raw_lines
+
+
+def _rewrite_row(input_row, uuid_idx, insert_uuid, molecule_uuid):
+    """Return a copy of the input row with the uuid inserted at (or
+    replacing the existing value at) uuid_idx, built with a single
+    concatenation rather than a copy followed by an insert.
+    """
+    tail_idx = uuid_idx if insert_uuid else uuid_idx + 1
+    return input_row[:uuid_idx] + [molecule_uuid] + input_row[tail_idx:]
+
+
+def _recorded_lines(input_file, lines):
+    """Yield the lines of the input file, also appending each one to the
+    given list, so the raw text of the rows read by a csv reader is known.
     """
+    for line in input_file:
+        lines.append(line)
+        yield line
+
+
+def _patch_line(line, input_row, delimiter, uuid_idx, insert_uuid,
+                molecule_uuid):
+    """Return the raw input line (without its line terminator) with the
+    uuid inserted at (or replacing the value at) uuid_idx. Only the uuid is
+    spliced into the line, the other columns are not re-serialised.
 
-    with open(input_filename, 'rt') as input_csv:
-        sniffer = csv.Sniffer()
-        sniffer.preferred = [',', '\t']
-        try:
-            input_dialect = sniffer.sniff(input_csv.read(1024))
-        except:  # pylint: disable=bare-except
-            event_logger.error\
-                ('Problem with file delimiter - must be a comma or a tab')
-            sys.exit(1)
-
-    with open(input_filename, 'rt') as input_csv:
-        # Reset file pointer after
-        input_reader = csv.DictReader(input_csv, dialect=input_dialect)
-
-        # Normally, the first row should contain headings and these are used
-        # in the dictionary for copying from the old to the new file.
-        # If headings=False, the headings used in the dictionary will be the
-        # first line of data - the file pointer is subsequently reset to the
-        # top of the file.
-        old_headings = next(input_reader)
-
-        input_cols = iter(old_headings)
-
-        # First column should contain be 'smiles'
-        smiles_col = next(input_cols)
-        # Second column should be 'uuid' if not generating uuid
-        second_col = next(input_cols)
-
-        if processing_vars['header']:
-            smiles = old_headings[smiles_col]
-            uuid_col = old_headings[second_col]
-        else:
-            smiles = smiles_col
-            uuid_col = second_col
-
-        if not noniso_smiles(smiles)[1]:
-            event_logger.error\
-                ('Problem with file - First column must be smiles')
-            sys.exit(1)
-
-        if not processing_vars['generate_uuid'] \
-                and not is_valid_uuid(uuid_col):
-            event_logger.error\
-                ('Problem with file - Second column heading must be uuid')
-            sys.exit(1)
-
-        if processing_vars['generate_uuid'] \
-                and not is_valid_uuid(uuid_col):
-            # If generating uuid and second column is not uuid then add uuid
-            # to output headings.
-            new_headings = [smiles_col, 'uuid', second_col]
-            second_col = 'uuid'
-            for col in input_cols:
-                new_headings.append(col)
-        else:
-            new_headings = old_headings
-
-    return input_dialect, old_headings, new_headings, smiles_col, second_col
-
-
-def _log_progress(num_processed):
-
-    if not num_processed % 50000:
-        event_logger.info('%s records processed', num_processed)
-
-
-def write_output_csv_fail(csv_rewriter, input_row, uuid_col):
-    """Still write the given record to the output file in the case of a smiles
-    standardisation failure. No uuid is generated in this case.
-    :param csv_rewriter: Dict Object
-    :param input_row:
-    :param uuid_col:
-    :returns: uuid for insert into file.
+    :returns: The patched line or None if the columns up to (and including
+              a replaced) uuid aren't in the line as they are in the row
+              (e.g. they are quoted). The row must then be written with a
+              csv writer.
     """
+    line = line.rstrip('\r\n')
+
+    pos = 0
+    for value in input_row[:uuid_idx]:
+        end = pos + len(value)
+        if not line.startswith(value, pos) \
+                or line[end:end + 1] != delimiter:
+            return None
+        pos = end + 1
+
+    if insert_uuid:
+        return line[:pos] + molecule_uuid + delimiter + line[pos:]
+
+    if len(input_row) <= uuid_idx \
+            or not line.startswith(input_row[uuid_idx], pos):
+        return None
+    end = pos + len(input_row[uuid_idx])
+    if line[end:end + 1] not in ('', delimiter):
+        return None
+    return line[:pos] + molecule_uuid + line[end:]
+
+
+def _batch_records(batch_smiles, unique_smiles, unique_records):
+    """Yield the standardised record for each smiles of a batch, given the
+    records of the batch's unique smiles (in order of first appearance).
+    Records are taken from unique_records as they are needed, so the
+    caller can start on the first records while the rest are standardised.
+    """
+    records = {}
+    unique_results = zip(unique_smiles, unique_records)
+    for smiles in batch_smiles:
+        if smiles not in records:
+            # The first appearance of a smiles is always the next unique one
+            unique, record = next(unique_results)
+            records[unique] = record
+        yield records[smiles]
+
+
+def _log_failed_records(rec_numbers, reason, first_rec_number,
+                        last_rec_number):
+    """Log the records (of a batch) that failed for the given reason.
+    Unless every failed record is to be logged, one event is logged for
+    them all, giving their number and the batch's records - logging an
+    event for every record can take longer than processing it.
+    Events are truncated to 79 characters, so the event doesn't list
+    the failed records.
+
+    :param rec_numbers: The numbers of the failed records
+    :param reason: Why the records failed
+    :param first_rec_number: The number of the batch's first record
+    :param last_rec_number: The number of the batch's last record
+    """
+    if not rec_numbers:
+        return
+
+    if processing_vars['log_failures'] or len(rec_numbers) == 1:
+        for rec_number in rec_numbers:
+            event_logger.info('Record %s %s', rec_number, reason)
+        return
+
+    event_logger.info('%s of records %s-%s %s', len(rec_numbers),
+                      first_rec_number, last_rec_number, reason)
+
+
+def _standardized_batches(input_reader, smiles_idx, raw_lines=None):
+    """Read the input rows in batches, standardising the smiles of each
+    batch in a pool of worker processes.
+
+    The results are returned in input order so the output files are written
+    in the same order (and with the same rec_number) as the input.
+    The InChI calculations are done in the workers too - RDKit serialises
+    InChI calls (and holds the GIL) so they can't be spread over threads.
+    Each smiles is only sent to the workers once per batch. Duplicates in
+    different batches may still hit the cache of the worker that
+    standardised them.
+
+    The next batch is read and sent to the workers before a batch is
+    returned, so the workers are kept busy while the caller writes it.
+
+    :param input_reader: csv reader instance of input csv to process
+    :param smiles_idx: index of the column in the input file that is the
+                       smiles.
+    :param raw_lines: the list the input lines are being recorded in
+                      (see _recorded_lines), or None.
+    :returns: (yields) a batch of input rows, the raw input lines of the
+              rows (or None if they're not known) and an iterator over
+              their standardised records
+    """
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=processing_vars['workers'],
+            initializer=_init_worker) as executor:
+        pending = None
+        while True:
+            batch = list(itertools.islice(input_reader, _BATCH_SIZE))
+
+            if batch:
+                # The raw lines can only be used if each row came from
+                # exactly one line (i.e. there are no blank lines or values
+                # spanning lines).
+                lines = None
+                if raw_lines is not None:
+                    if len(raw_lines) == len(batch):
+                        lines = list(raw_lines)
+                    raw_lines.clear()
+
+                batch_smiles = [row[smiles_idx] for row in batch]
+                unique_smiles = list(dict.fromkeys(batch_smiles))
+                submitted = batch, lines, _batch_records(
+                    batch_smiles, unique_smiles,
+                    executor.map(_standardize_record, unique_smiles,
+                                 chunksize=_CHUNK_SIZE))
+
+            if pending:
+                yield pending
+            if not batch:
+                return
+            pending = submitted
+
+
+def _process_with_uuid(output_writer, input_reader, raw_lines,
+                       output_csv_file, input_headings, smiles_idx, uuid_idx,
+                       insert_uuid, fields):
+    """Process the dataset generating a new uuid for each molecule, and
+    rewrite every input record (with its uuid) to the new smi file.
+
+    Where possible the record is rewritten by patching the uuid into its
+    raw input line (from raw_lines) rather than re-serialising every column.
+
+    :returns: The number of items processed, the number of failures, the
+              number of molecules and the fields for the Fields Descriptor
+    """
+
+    num_processed = 0
+    num_failed = 0
+    num_mols = 0
+    next_progress = _PROGRESS_INTERVAL
+
+    # The rewritten records for each batch are collected in a buffer
+    # (using a csv writer for records whose line can't be patched).
+    line_terminator = dialect.lineterminator
+    delimiter = dialect.delimiter
+    rewritten_buffer = io.StringIO()
+    buffer_writer = csv.writer(rewritten_buffer, dialect=dialect)
+
+    # Bound methods used for every record, looked up once
+    log_info = event_logger.info
+    write_rewritten_line = rewritten_buffer.write
+    write_rewritten_row = buffer_writer.writerow
+
+    # Whether the fields for the Fields Descriptor have been found
+    fields_found = False
+
+    for batch, lines, records in _standardized_batches(
+            input_reader, smiles_idx, raw_lines):
+        if lines is None:
+            lines = [None] * len(batch)
+
+        # Enough uuids for every row in the batch
+        next_uuid = _uuid_batch(len(batch)).pop
+        # The rows written to the loader file for this batch,
+        # which are written (with writerows) at the end of the batch.
+        loader_rows = []
+        add_loader_row = loader_rows.append
+        # The records of this batch that failed to standardize
+        failed_records = []
+
+        for row, line, record in zip(batch, lines, records):
+            num_processed += 1
+            if num_processed == next_progress:
+                log_info('%s records processed', num_processed)
+                next_progress += _PROGRESS_INTERVAL
+
+            if record:
+                num_mols += 1
+                molecule_uuid = next_uuid()
+
+                if not fields_found:
+                    # Save the fields found in the first record that is
+                    # loaded to create the Fields descriptor. The columns
+                    # are fixed after this record.
+                    for col, value in zip(input_headings, row):
+                        fields = check_name_in_fields(col, value, fields)
+                    fields_found = True
+
+                # The standardised data for the tmploadercsv file
+                # (in _OUTPUT_COLUMNS order)
+                add_loader_row(record + (molecule_uuid, num_processed))
+            else:
+                # Still write the record to the smi file in the case of a
+                # smiles standardisation failure. No uuid is generated.
+                num_failed += 1
+                molecule_uuid = ''
+                failed_records.append(num_processed)
+
+            patched_line = None
+            if line:
+                patched_line = _patch_line(line, row, delimiter, uuid_idx,
+                                           insert_uuid, molecule_uuid)
+            if patched_line is None:
+                write_rewritten_row(_rewrite_row(row, uuid_idx, insert_uuid,
+                                                 molecule_uuid))
+            else:
+                write_rewritten_line(patched_line + line_terminator)
 
-    output_row = dict.fromkeys(output_headings, 0)
-    for col in input_row:
-        output_row[col] = input_row[col]
-    output_row[uuid_col] = ''
-    csv_rewriter.writerow(output_row)
+        _log_failed_records(failed_records, 'failed to standardize in RDKit',
+                            num_processed - len(batch) + 1, num_processed)
 
+        output_csv_file.write(rewritten_buffer.getvalue())
+        rewritten_buffer.seek(0)
+        rewritten_buffer.truncate()
+        output_writer.writerows(loader_rows)
 
-def write_output_csv(csv_rewriter, input_row, uuid_col, fields):
-    """Write the given record to the output smi file with a generated uuid
-    :param csv_rewriter: Dict Object
-    :param input_row:
-    :param uuid_col:
-    :param fields:
-    :returns: uuid for insert into file, fields for the Fields Descriptor
+    return num_processed, num_failed, num_mols, fields
+
+
+def _process_with_existing_uuid(output_writer, input_reader, smiles_idx,
+                                uuid_idx, fields):
+    """Process the dataset using the uuid each record already contains.
+    Records without a valid uuid are skipped.
+
+    :returns: The number of items processed, the number of failures, the
+              number of molecules and the fields for the Fields Descriptor
     """
 
-    molecule_uuid = str(uuid.uuid4())
-    output_row = dict.fromkeys(output_headings, 0)
+    num_processed = 0
+    num_failed = 0
+    num_mols = 0
+    next_progress = _PROGRESS_INTERVAL
+
+    # Bound methods used for every record, looked up once
+    log_info = event_logger.info
+
+    for batch, _, records in _standardized_batches(input_reader,
+                                                   smiles_idx):
+        # The rows written to the loader file for this batch,
+        # which are written (with writerows) at the end of the batch.
+        loader_rows = []
+        add_loader_row = loader_rows.append
+        # The records of this batch that failed (for each reason)
+        failed_records = []
+        invalid_uuid_records = []
+
+        for row, record in zip(batch, records):
+            num_processed += 1
+            if num_processed == next_progress:
+                log_info('%s records processed', num_processed)
+                next_progress += _PROGRESS_INTERVAL
+
+            if not record:
+                num_failed += 1
+                failed_records.append(num_processed)
+                continue
+
+            num_mols += 1
+            molecule_uuid = row[uuid_idx]
+            if not is_valid_uuid(molecule_uuid):
+                num_failed += 1
+                invalid_uuid_records.append(num_processed)
+                continue
 
-    # The other columns will be identical to the input.
-    for col in input_row:
-        output_row[col] = input_row[col]
-        # Save any new fields found in list to create Fields descriptor
-        fields = check_name_in_fields(col, input_row[col], fields)
+            # The standardised data for the tmploadercsv file
+            # (in _OUTPUT_COLUMNS order)
+            add_loader_row(record + (molecule_uuid, num_processed))
 
-    output_row[uuid_col] = molecule_uuid
+        first_rec_number = num_processed - len(batch) + 1
+        _log_failed_records(failed_records, 'failed to standardize in RDKit',
+                            first_rec_number, num_processed)
+        _log_failed_records(invalid_uuid_records,
+                            'did not contain a valid uuid',
+                            first_rec_number, num_processed)
 
-    # Write the standardised data to the tmploadercsv file
-    csv_rewriter.writerow(output_row)
+        output_writer.writerows(loader_rows)
 
-    return molecule_uuid, fields
+    return num_processed, num_failed, num_mols, fields
 
 
-def process_file(output_writer, input_reader, output_csv_file,
-                 output_csv_headings, smiles_col, uuid_col):
+def process_file(output_writer, input_reader, raw_lines, output_csv_file,
+                 input_csv_headings, output_csv_headings, smiles_idx,
+                 uuid_idx):
     """Process the given dataset and process the molecule
     information, writing it as csv-separated fields to the output.
 
     As we load the molecule we 'standardise' the SMILES and
     add inchi information.
 
-    :param output_writer: DictWriter instance of csv output file
-    :param input_reader: DictReader instance of input csv to process
+    The processing loop is specialised on whether uuids are generated,
+    which is decided here, once, rather than for every record.
+
+    :param output_writer: csv writer instance of csv output file
+    :param input_reader: reader for the input rows to process
+    :param raw_lines: the list the raw input lines are recorded in
     :param output_csv_file: SMI File to re-write if adding uuid
+    :param input_csv_headings: Input file headings
     :param output_csv_headings: SMI File headings
-    :param smiles_col: the column in the input file that is the smiles.
-    :param uuid_col: the column in the input/output file that is the uuid.
+    :param smiles_idx: index of the column in the input file that is the
+                       smiles.
+    :param uuid_idx: index of the column in the input/output file that is
+                     the uuid.
     :returns: The number of items processed and the number of failures
     """
 
-    num_processed = 0
-    num_failed = 0
-    num_mols = 0
-
     # Note, if there are no headings then the code can't find the smiles and
     # uuid to put in the FieldsDescriptor
-    fields = {smiles_col : 'string', uuid_col: 'string'}
+    fields = {output_csv_headings[smiles_idx]: 'string',
+              output_csv_headings[uuid_idx]: 'string'}
 
-    # Jump the first line if there is a header
-    if processing_vars['header']:
-        next(input_reader)
-
-    # This line is here to avoid a lint warning
-    csv_rewriter = object()
-    if processing_vars['generate_uuid']:
-        # Open smi file if (re)generating uuid column
-        csv_rewriter = csv.DictWriter(output_csv_file,
-                                      fieldnames=output_csv_headings,
-                                      dialect=dialect)
-        if processing_vars['header']:
-            csv_rewriter.writeheader()
-
-    for row in input_reader:
-        num_processed += 1
-        _log_progress (num_processed)
-
-        # Standardise the smiles and return a standard molecule.
-        noniso = noniso_smiles(row[smiles_col])
-
-        if not noniso[1]:
-            num_failed += 1
-            if processing_vars['generate_uuid']:
-                write_output_csv_fail(csv_rewriter, row, uuid_col)
-            event_logger.info('Record %s failed to standardize in RDKit',
-                              num_processed)
-            continue
-
-        num_mols += 1
-        if processing_vars['generate_uuid']:
-            # If we are generating a UUID for the molecules then we need to
-            # rewrite the input record to a new smi file.
-            molecule_uuid, fields = write_output_csv(csv_rewriter, row,
-                                                     uuid_col, fields)
-        else:
-            # if we are not generating a UUID then the molecule name must
-            # already contain a UUID.
-            if is_valid_uuid(row[uuid_col]):
-                molecule_uuid = row[uuid_col]
-            else:
-                num_failed += 1
-                if processing_vars['generate_uuid']:
-                    write_output_csv_fail(csv_rewriter, row, uuid_col)
-                event_logger.info('Record %s did not contain a valid uuid',
-                                  num_processed)
-                continue
+    if not processing_vars['generate_uuid']:
+        return _process_with_existing_uuid(output_writer, input_reader,
+                                           smiles_idx, uuid_idx, fields)
 
-        inchis = Chem.inchi.MolToInchi(noniso[1], '')
+    # The uuid column is added to the input columns (rather than replacing
+    # the existing column) if it's a new column in the output headings.
+    insert_uuid = len(output_csv_headings) > len(input_csv_headings)
 
-        # Write the standardised data to the tmploadercsv file
-        output_writer.writerow({'smiles': noniso[0],
-                                'inchis': inchis,
-                                'inchik': Chem.inchi.InchiToInchiKey(inchis),
-                                'hac': noniso[1].GetNumHeavyAtoms(),
-                                'molecule-uuid': molecule_uuid,
-                                'rec_number': num_processed})
+    # Open smi file if (re)generating uuid column
+    csv_rewriter = csv.writer(output_csv_file, dialect=dialect)
+    if processing_vars['header']:
+        csv_rewriter.writerow(output_csv_headings)
 
-    if processing_vars['generate_uuid']:
-        # End and Close the SMI file if there are no more rows in the input
-        # file.
-        output_csv_file.close()
+    result = _process_with_uuid(output_writer, input_reader, raw_lines,
+                                output_csv_file, input_csv_headings,
+                                smiles_idx, uuid_idx, insert_uuid, fields)
 
-    return num_processed, num_failed, num_mols, fields
+    # End and Close the SMI file if there are no more rows in the input
+    # file.
+    output_csv_file.close()
+
+    return result
 
 
 def process_fields_descriptor(fields):
@@ -394,8 +739,10 @@ def process_fields_descriptor(fields):
     # (say it's a new version of an existing file or derived from an
     # existing file), then prime the fields list
     if os.path.isfile(meta_in_filename):
-        with open(meta_in_filename, 'rt') as meta_in_file:
-            metadata = Metadata(**json.load(meta_in_file))
+        with open(meta_in_filename, 'rb') as meta_in_file:
+            meta_in = meta_in_file.read()
+            metadata = Metadata(**(orjson.loads(meta_in) if orjson
+                                   else json.loads(meta_in)))
             f_desc = metadata.get_compiled_fields()
             fd_in_desc = f_desc['description']
             fd_in_fields = f_desc['fields']
@@ -431,9 +778,11 @@ def process_fields_descriptor(fields):
             fd_new.add_field(field, False)
 
     # Recreate output and write the list of annotations to it.
-    with open(meta_out_filename, "w") as meta_file:
+    with open(meta_out_filename, "wb") as meta_file:
         metadata.add_annotation(fd_new)
-        json.dump(metadata.to_dict(), meta_file)
+        meta_out = metadata.to_dict()
+        meta_file.write(orjson.dumps(meta_out) if orjson
+                        else json.dumps(meta_out).encode())
     event_logger.info('FieldsDescriptor generated')
 
 
@@ -450,6 +799,8 @@ if __name__ == '__main__':
     processing_vars = get_processing_variables()
     basic_logger.info('generate_uuid=%s', processing_vars['generate_uuid'])
     basic_logger.info('header=%s', processing_vars['header'])
+    basic_logger.info('workers=%s', processing_vars['workers'])
+    basic_logger.info('log_failures=%s', processing_vars['log_failures'])
     basic_logger.info('SMI Data Loader')
 
     # Suppress basic RDKit logging...
@@ -458,18 +809,20 @@ if __name__ == '__main__':
     basic_logger.info('Checking input file format %s...', dataset_filename)
 
     # Non-invasive way of allowing gzip files to be sent.
-    # If the input file is a gzip, then uncompress for processing
-    # Recompress on exit
+    # If the input file is a gzip, then it is decompressed as it's read
+    # (and the rewritten file is compressed as it's written).
+    # The metadata filename is based on the uncompressed filename.
     input_filename = os.path.join(dataset_input_path, dataset_filename)
     process_filename = dataset_filename
-    compress: bool = False
     if dataset_filename.endswith('.gz'):
-        compress: bool = True
-        input_filename, process_filename = \
-            uncompress_file()
+        process_filename = os.path.splitext(dataset_filename)[0]
 
-    dialect, input_headings, output_headings, input_smiles_col, input_uuid_col\
-        = check_file_format()
+    # The input file is opened once, for both the format check and the
+    # processing.
+    input_file = open_dataset_file(input_filename, 'r')
+    dialect, input_headings, output_headings, input_smiles_idx, \
+        input_uuid_idx, input_reader, input_raw_lines = \
+        check_file_format(input_file)
 
     loader_filename = os.path.join(dataset_output_path, 'tmploaderfile.csv')
     meta_filename, dummy = get_metadata_filenames(process_filename)
@@ -486,27 +839,24 @@ if __name__ == '__main__':
     basic_logger.info('Writing annotations to %s...', meta_out_filename)
 
     # Open the file we'll write the standardised data set to.
-    with open(loader_filename, 'wt') as csvfile:
+    with open(loader_filename, 'wt', buffering=_BUFFER_SIZE,
+              newline='') as csvfile:
         event_logger.info('Processing %s...', input_filename)
-        reader = csv.DictReader(open(input_filename, 'rt'), dialect=dialect,
-                                fieldnames=input_headings)
-        writer = csv.DictWriter(csvfile, fieldnames=_OUTPUT_COLUMNS)
-        writer.writeheader()
+        writer = csv.writer(csvfile)
+        writer.writerow(_OUTPUT_COLUMNS)
 
         output_csv: object = None
         if processing_vars['generate_uuid']:
             output_filename = \
-                os.path.join(dataset_output_path, process_filename)
-            output_csv = open(output_filename, 'wt')
+                os.path.join(dataset_output_path, dataset_filename)
+            output_csv = open_dataset_file(output_filename, 'w')
 
         processed, failed, mols, file_fields =\
-            process_file(writer, reader, output_csv,
-                         output_headings, input_smiles_col,
-                         input_uuid_col)
-
-    if compress:
-        compress_file()
+            process_file(writer, input_reader, input_raw_lines, output_csv,
+                         input_headings, output_headings, input_smiles_idx,
+                         input_uuid_idx)
 
+    input_file.close()
     process_fields_descriptor(file_fields)
 
     # Summary
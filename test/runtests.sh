@@ -165,6 +165,43 @@ rm -rf -f test/${TEST_TYPE}/${TEST_DIR}/output
 mkdir -p test/${TEST_TYPE}/${TEST_DIR}/output
 IMAGE_NAME=${PWD##*/} docker-compose up
 
+# -----------------------------------------------------------------------------
+# Success test 7.1 - comma separated, CRLF, quoted values, header
+# -----------------------------------------------------------------------------
+export TEST_TYPE=success
+export TEST_DIR=7
+export DATASET_FILENAME=test7-csv-quoted.smi
+export DATASET_EXTRA_VARIABLES=
+export DATASET_OUTPUT_FORMAT=
+rm -rf -f test/${TEST_TYPE}/${TEST_DIR}/output
+mkdir -p test/${TEST_TYPE}/${TEST_DIR}/output
+IMAGE_NAME=${PWD##*/} docker-compose up
+mv test/${TEST_TYPE}/${TEST_DIR}/output/tmploaderfile.csv test/${TEST_TYPE}/${TEST_DIR}/output/tmploaderfile7-1.csv
+
+# -----------------------------------------------------------------------------
+# Success test 7.2 - comma separated, CRLF, quoted values, uuid exists, generate
+# -----------------------------------------------------------------------------
+export TEST_TYPE=success
+export TEST_DIR=7
+export DATASET_FILENAME=test7-csv-uuid-quoted.smi
+export DATASET_EXTRA_VARIABLES=
+export DATASET_OUTPUT_FORMAT=
+mkdir -p test/${TEST_TYPE}/${TEST_DIR}/output
+IMAGE_NAME=${PWD##*/} docker-compose up
+mv test/${TEST_TYPE}/${TEST_DIR}/output/tmploaderfile.csv test/${TEST_TYPE}/${TEST_DIR}/output/tmploaderfile7-2.csv
+
+# -----------------------------------------------------------------------------
+# Success test 7.3 - comma separated, CRLF, blank lines, values spanning lines
+# -----------------------------------------------------------------------------
+export TEST_TYPE=success
+export TEST_DIR=7
+export DATASET_FILENAME=test7-csv-blank-lines.smi
+export DATASET_EXTRA_VARIABLES=
+export DATASET_OUTPUT_FORMAT=
+mkdir -p test/${TEST_TYPE}/${TEST_DIR}/output
+IMAGE_NAME=${PWD##*/} docker-compose up
+mv test/${TEST_TYPE}/${TEST_DIR}/output/tmploaderfile.csv test/${TEST_TYPE}/${TEST_DIR}/output/tmploaderfile7-3.csv
+
 # -----------------------------------------------------------------------------
 # Failure test 1.1 - comma separated - fail due to no smiles column
 # -----------------------------------------------------------------------------
@@ -186,3 +223,25 @@ export DATASET_EXTRA_VARIABLES='header=False'
 export DATASET_OUTPUT_FORMAT=
 mkdir -p test/${TEST_TYPE}/${TEST_DIR}/output
 IMAGE_NAME=${PWD##*/} docker-compose up
+
+# -----------------------------------------------------------------------------
+# Failure test 2.1 - fail due to unrecognised true/false variable value
+# -----------------------------------------------------------------------------
+export TEST_TYPE=failure
+export TEST_DIR=2
+export DATASET_FILENAME=test2-csv-bad-variable.smi
+export DATASET_EXTRA_VARIABLES='header=maybe'
+export DATASET_OUTPUT_FORMAT=
+mkdir -p test/${TEST_TYPE}/${TEST_DIR}/output
+IMAGE_NAME=${PWD##*/} docker-compose up
+
+# -----------------------------------------------------------------------------
+# Failure test 2.2 - fail due to blank true/false variable value
+# -----------------------------------------------------------------------------
+export TEST_TYPE=failure
+export TEST_DIR=2
+export DATASET_FILENAME=test2-csv-bad-variable.smi
+export DATASET_EXTRA_VARIABLES='generate_uuid='
+export DATASET_OUTPUT_FORMAT=
+mkdir -p test/${TEST_TYPE}/${TEST_DIR}/output
+IMAGE_NAME=${PWD##*/} docker-compose up